@@ -1,73 +1,232 @@
+import io
+import collections
+import itertools
 import os
+import time
 import zipfile
 import pandas as pd
 import fitz  # PyMuPDF
 import logging
-import shutil
-from flask import Flask, request, render_template, after_this_request, send_file, send_from_directory, abort
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, request, render_template, send_from_directory, abort
 from werkzeug.utils import secure_filename
 
 # --- Configuration ---
-# Vercel requires writing to /tmp
-UPLOAD_FOLDER = '/tmp/uploads'
-COMPLETED_FOLDER = '/tmp/completed'
 STATIC_FOLDER = 'static'
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['COMPLETED_FOLDER'] = COMPLETED_FOLDER
+
+# Bundled examples are fixed at deploy time, so list them once instead of stat-ing on every download
+EXAMPLE_DIR = os.path.join(app.static_folder, 'examples')
+EXAMPLE_FILES = frozenset(
+    f for f in (os.listdir(EXAMPLE_DIR) if os.path.isdir(EXAMPLE_DIR) else [])
+    if os.path.isfile(os.path.join(EXAMPLE_DIR, f))
+)
+
+# Default template as fallback
+# Robustly find file relative to this script, not CWD
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TEMPLATE_PATH = os.path.join(BASE_DIR, "BLANK_CDAI_APP_DEC-25.pdf")
+
+# UPDATED COORDINATES (X, Y)
+FIELD_COORDS_P1 = {
+    'mc': (75, 250), 
+    'lastname': (75, 330), 
+    'firstname': (75, 360),
+    'dob': (75, 400), 
+    'wt': (75, 430), 
+    'ht': (75, 475),
+    # 'location': (585.36, 347.04), # User has not updated this
+}
+# FIELD_COORDS_P2 = {'last': (731.52, 86.16)} # Removed
+FIELD_COORDS_P3 = {'wt': (325, 525)}
+
+def _flatten_coords(field_coords):
+    # A field may map to a single (x, y) or a list of them; flatten to (field, x, y) tuples
+    return tuple(
+        (field, x, y)
+        for field, coord in field_coords.items()
+        for (x, y) in (coord if isinstance(coord[0], tuple) else [coord])
+    )
+
+# Flattened once at startup so the per-row fill is a plain loop
+COORDS_P1 = _flatten_coords(FIELD_COORDS_P1)
+COORDS_P3 = _flatten_coords(FIELD_COORDS_P3)
+
+# (page index, coordinates) to fill; P2 and any extra pages are left untouched
+PAGE_COORDS = ((0, COORDS_P1), (2, COORDS_P3))
+
+# Base-14 Helvetica, registered once per filled page
+FONT_NAME = "helv"
+
+# Key jobs use for the bundled default template (secure_filename can never produce it)
+DEFAULT_TEMPLATE_KEY = "<default>"
+
+# Below this many rows the pool round-trip costs more than rendering in-process
+MIN_PARALLEL_ROWS = 16
+# Cap on rows per pool task, so results come back (and can be streamed) in steady chunks
+MAX_BATCH_ROWS = 8
+
+# Workers are never forked from the (threaded) server process
+MP_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Per-process counter keeps run ids unique when two requests land in the same nanosecond
+_run_counter = itertools.count()
 
 # Setup basic logging
 logging.basicConfig(level=logging.INFO)
 
 # --- Helper Functions ---
 
-def split_pdf(input_pdf_path, output_dir):
-    app.logger.info(f"Splitting PDF: {input_pdf_path}")
-    pdf_document = fitz.open(input_pdf_path)
-    split_paths = []
-    for page_num in range(len(pdf_document)):
-        split_pdf_path = os.path.join(output_dir, f"page_{page_num + 1}.pdf")
-        split_paths.append(split_pdf_path)
-        new_pdf = fitz.open()
-        new_pdf.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)
-        new_pdf.save(split_pdf_path)
-        new_pdf.close()
-    pdf_document.close()
-    return split_paths
-
-def fill_page(pdf_path, data, coordinates):
-    pdf_document = fitz.open(pdf_path)
-    page = pdf_document.load_page(0)
-    for field, coord in coordinates.items():
-        if field in data and pd.notna(data[field]):
-            value = str(data[field])
-            # coord is expected to be (x, y)
-            if isinstance(coord[0], tuple): # handle list of coords if needed
-                 for c in coord:
-                     x, y = c
-                     # Removed draw_rect to stop obscuring PDF lines
-                     # Rotation 0 for horizontal normal reading
-                     page.insert_text((x, y+5), value, fontsize=12, rotate=0, color=(0, 0, 0))
-            else:
-                x, y = coord
-                # Removed draw_rect to stop obscuring PDF lines
-                page.insert_text((x, y+5), value, fontsize=12, rotate=0, color=(0, 0, 0))
-
-    temp_pdf_path = pdf_path.replace(".pdf", "_filled.pdf")
-    pdf_document.save(temp_pdf_path)
-    pdf_document.close()
-    return temp_pdf_path
-
-def merge_pdfs(output_pdf_path, pdf_paths):
-    merged_pdf = fitz.open()
-    for pdf_path in pdf_paths:
-        if os.path.exists(pdf_path):
-            pdf_document = fitz.open(pdf_path)
-            merged_pdf.insert_pdf(pdf_document)
-            pdf_document.close()
-    merged_pdf.save(output_pdf_path)
-    merged_pdf.close()
+def fill_plan(template_bytes):
+    # Resolve which PAGE_COORDS entries fit this template once, rather than checking page_count on every row
+    try:
+        with fitz.open(stream=template_bytes, filetype='pdf') as doc:
+            page_count = doc.page_count
+    except Exception:
+        return PAGE_COORDS # unreadable template; the row render reports the actual error
+    return tuple((page_num, coords) for page_num, coords in PAGE_COORDS if page_num < page_count)
+
+# Default template as (bytes, plan, mtime), parsed by fitz from memory on every row instead of re-reading the file.
+# Replaced as a whole tuple so concurrent requests never see bytes and plan from different versions.
+_TEMPLATE_CACHE = None
+
+def load_default_template():
+    global _TEMPLATE_CACHE
+    mtime = os.path.getmtime(DEFAULT_TEMPLATE_PATH)
+    cache = _TEMPLATE_CACHE
+    if cache is None or mtime != cache[2]: # re-read only if the file changed on disk
+        with open(DEFAULT_TEMPLATE_PATH, 'rb') as fh:
+            template_bytes = fh.read()
+        cache = (template_bytes, fill_plan(template_bytes), mtime)
+        _TEMPLATE_CACHE = cache
+        app.logger.info(f"Loaded default template: {DEFAULT_TEMPLATE_PATH}")
+    return cache[0], cache[1]
+
+# Warm the template cache at startup so the first request doesn't pay for the read
+if os.path.exists(DEFAULT_TEMPLATE_PATH):
+    load_default_template()
+
+def fill_page_inplace(page, data, coordinates):
+    # coordinates is a flat sequence of (field, x, y), see COORDS_P1
+    page.insert_font(fontname=FONT_NAME)
+    for field, x, y in coordinates:
+        value = data.get(field)
+        if value is not None:
+            # Removed draw_rect to stop obscuring PDF lines
+            # Rotation 0 for horizontal normal reading
+            page.insert_text((x, y+5), str(value), fontname=FONT_NAME, fontsize=12, rotate=0, color=(0, 0, 0))
+
+class ZipChunkBuffer(io.RawIOBase):
+    # Write-only, unseekable sink for ZipFile; drain() hands back whatever has been written so far
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def read_data_file(data_bytes, ext):
+    # CSV stays on the default C parser: it pads short rows and rejects non-UTF-8 input,
+    # where the pyarrow engine errors on the former and returns raw bytes cells for the latter
+    if ext == '.csv':
+        return pd.read_csv(io.BytesIO(data_bytes))
+    # Prefer the calamine parser for Excel; fall back to pandas' default when it isn't installed
+    # (ImportError) or this pandas doesn't know the engine / calamine rejects the file (ValueError)
+    try:
+        return pd.read_excel(io.BytesIO(data_bytes), engine='calamine')
+    except (ImportError, ValueError):
+        app.logger.info("Fast spreadsheet engine unavailable, using default pandas reader")
+        return pd.read_excel(io.BytesIO(data_bytes))
+
+def _render_row(data, template_bytes, plan):
+    # Top-level so it can be pickled into a worker process
+    # Edit the template pages in memory and save once; plan comes from fill_plan()
+    with fitz.open(stream=template_bytes, filetype='pdf') as doc:
+        for page_num, coords in plan:
+            fill_page_inplace(doc.load_page(page_num), data, coords)
+        return doc.tobytes(garbage=0, deflate=True)
+
+def _render_batch(jobs, templates):
+    # Worker entry point: a batch carries only the templates its rows use, so each crosses the pipe once per batch
+    results = []
+    for data, template_key in jobs:
+        try:
+            results.append(_render_row(data, *templates[template_key]))
+        except Exception as e:
+            results.append(e)
+    return results
+
+# One pool shared by every request, created on first use so worker start-up is paid once per server process
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+def _shared_executor():
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=MP_CONTEXT)
+        return _EXECUTOR
+
+def _discard_shared_executor(executor):
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is executor:
+            _EXECUTOR = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def render_rows(jobs, templates):
+    # Yields the PDF bytes or the raised exception for each (data, template_key) job, in order;
+    # templates maps every key used to (template_bytes, plan)
+    done = 0
+    workers = os.cpu_count() or 1
+    if len(jobs) >= MIN_PARALLEL_ROWS and workers > 1:
+        # Contiguous batches keep row order; at most `workers` are in flight so finished PDFs don't pile up
+        size = min(MAX_BATCH_ROWS, -(-len(jobs) // workers))
+        batches = iter([jobs[i:i + size] for i in range(0, len(jobs), size)])
+        pending = collections.deque()
+        executor = None
+        try:
+            executor = _shared_executor()
+            def submit(batch):
+                needed = {template_key: templates[template_key] for _, template_key in batch}
+                pending.append(executor.submit(_render_batch, batch, needed))
+            for batch in itertools.islice(batches, workers):
+                submit(batch)
+            while pending:
+                results = pending.popleft().result()
+                batch = next(batches, None)
+                if batch is not None:
+                    submit(batch)
+                for result in results:
+                    yield result
+                    done += 1
+            return
+        except BrokenProcessPool as e:
+            app.logger.warning(f"Process pool broke, rendering remaining rows serially: {e}")
+            _discard_shared_executor(executor)
+        except (OSError, NotImplementedError) as e:
+            # Some serverless runtimes (no /dev/shm) can't start worker processes
+            app.logger.warning(f"Process pool unavailable, rendering serially: {e}")
+        finally:
+            for future in pending:
+                future.cancel()
+    for data, template_key in jobs[done:]:
+        try:
+            yield _render_row(data, *templates[template_key])
+        except Exception as e:
+            yield e
 
 # --- Main Application Logic ---
 
@@ -78,12 +237,10 @@ def main_page():
 @app.route('/download/<path:filename>', methods=['GET'])
 def download_example(filename):
     # Serve example files from the static/examples directory bundled with the app
-    example_dir = os.path.join(app.static_folder, 'examples')
-    file_path = os.path.join(example_dir, filename)
-    if not os.path.isfile(file_path):
-        app.logger.warning(f"Example download missing: {file_path}")
+    if filename not in EXAMPLE_FILES:
+        app.logger.warning(f"Example download missing: {os.path.join(EXAMPLE_DIR, filename)}")
         abort(404)
-    return send_from_directory(example_dir, filename, as_attachment=True)
+    return send_from_directory(EXAMPLE_DIR, filename, as_attachment=True)
 
 @app.route('/process', methods=['POST'])
 def process_files():
@@ -95,57 +252,46 @@ def process_files():
     data_file = request.files['data_file']
     template_files = request.files.getlist('template_files')
     
-    # Default template as fallback
-    # Robustly find file relative to this script, not CWD
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    DEFAULT_TEMPLATE_PATH = os.path.join(BASE_DIR, "BLANK_CDAI_APP_DEC-25.pdf")
-    
-    if not os.path.exists(DEFAULT_TEMPLATE_PATH):
+    try:
+        default_template = load_default_template()
+    except OSError:
         app.logger.error(f"Default template not found at: {DEFAULT_TEMPLATE_PATH}")
         return f"Server Error: Default PDF template not found at {DEFAULT_TEMPLATE_PATH}", 500
 
     if data_file.filename == '':
         return "No selected file", 400
 
-    run_id = secure_filename(pd.Timestamp.now().strftime('%Y%m%d_%H%M%S_%f'))
-    session_upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], run_id)
-    session_completed_folder = os.path.join(app.config['COMPLETED_FOLDER'], run_id)
-    os.makedirs(session_upload_folder, exist_ok=True)
-    os.makedirs(session_completed_folder, exist_ok=True)
-
+    # Parse the spreadsheet straight from the upload; nothing is written to disk for a run
     data_filename = secure_filename(data_file.filename)
-    data_path = os.path.join(session_upload_folder, data_filename)
-    data_file.save(data_path)
+    ext = os.path.splitext(data_filename)[1].lower()
+    df = read_data_file(data_file.read(), ext)
+    if df.empty:
+        return "Empty data file", 400
+
+    run_id = f"{time.time_ns()}_{next(_run_counter)}"
 
-    # Save uploaded templates and build a lookup dictionary by doctor last name
+    # Read uploaded templates into memory and build a lookup dictionary by doctor last name
     # Expected filename format: CDAI_BLANK_Lastname.pdf or any name containing the doctor's last name
     template_lookup = {}
     for tpl_file in template_files:
         if tpl_file and tpl_file.filename:
             tpl_filename = secure_filename(tpl_file.filename)
-            tpl_path = os.path.join(session_upload_folder, tpl_filename)
-            tpl_file.save(tpl_path)
+            tpl_bytes = tpl_file.read()
             # Extract doctor name from filename (case-insensitive)
             # e.g., "CDAI_BLANK_Smith.pdf" -> "smith"
             name_part = os.path.splitext(tpl_filename)[0].lower()
-            template_lookup[name_part] = tpl_path
+            template_lookup[name_part] = (tpl_bytes, fill_plan(tpl_bytes))
             app.logger.info(f"Uploaded template: {tpl_filename} -> key: {name_part}")
-    
-    # Copy default template to session folder as fallback
-    default_session_template = os.path.join(session_upload_folder, "default_template.pdf")
-    shutil.copy(DEFAULT_TEMPLATE_PATH, default_session_template)
 
-    ext = os.path.splitext(data_filename)[1].lower()
-    df = pd.read_csv(data_path) if ext == '.csv' else pd.read_excel(data_path)
-    
-    df.columns = [c.strip().lower().replace(" ", "") for c in df.columns]
+    df.columns = df.columns.str.strip().str.lower().str.replace(" ", "", regex=False)
     df.rename(columns={
         'birthdate': 'dob', 'medicarenumber': 'mc', 'infusionlocation': 'location',
         'height': 'ht', 'weight': 'wt',
     }, inplace=True)
+    # Blank cells become None up front so the per-row code is plain dict lookups
+    df = df.astype(object).where(pd.notna(df), None)
 
     processing_log = []
-    generated_files = []
 
     processing_log.append("--- CDAI PDF Processing Report ---")
     processing_log.append(f"Data file: {data_filename}")
@@ -153,98 +299,64 @@ def process_files():
     processing_log.append(f"Default template: {DEFAULT_TEMPLATE_PATH}")
     processing_log.append("\n---\n")
 
-    for index, row in df.iterrows():
-        data = row.to_dict()
-        patient_name = f"{data.get('firstname', '')} {data.get('lastname', 'N/A')}"
+    rows = []
+    jobs = []
+    for index, data in enumerate(df.to_dict(orient='records')):
+        # Blank cells are None (see above), so use `or` for the fallbacks rather than .get defaults
+        patient_name = f"{data.get('firstname') or ''} {data.get('lastname') or 'N/A'}"
         row_identifier = f"Row {index + 2} (Patient: {patient_name})"
 
         # Get gastroenterologist name to match with uploaded template
-        gastro = str(data.get('gastroenterologist', '')).strip().lower()
+        gastro = str(data.get('gastroenterologist') or '').strip().lower()
         
         # Find matching template: check if any template filename contains the gastro name
         matched_template = None
-        for tpl_key, tpl_path in template_lookup.items():
+        for tpl_key in template_lookup:
             if gastro and gastro in tpl_key:
-                matched_template = tpl_path
+                matched_template = tpl_key
                 break
         
         # Use matched template or fall back to default
-        template_to_use = matched_template if matched_template else default_session_template
+        template_key = matched_template if matched_template else DEFAULT_TEMPLATE_KEY
         template_source = "uploaded" if matched_template else "default"
         
-        patient_lastname = data.get('lastname', 'unknown_lastname')
-        patient_firstname = data.get('firstname', 'unknown_firstname')
-        filename = f"{patient_lastname}_{patient_firstname}_CDAI.pdf"
-        out_pdf = os.path.join(session_completed_folder, filename)
+        patient_lastname = data.get('lastname') or 'unknown_lastname'
+        patient_firstname = data.get('firstname') or 'unknown_firstname'
+        # Names come straight from the sheet, so strip path separators etc. before they become zip entry names
+        filename = secure_filename(f"{patient_lastname}_{patient_firstname}_CDAI.pdf")
 
-        try:
-            pages = split_pdf(template_to_use, session_upload_folder)
-            filled_pages = []
-            
-            # UPDATED COORDINATES (X, Y)
-            coords_p1 = {
-                'mc': (75, 250), 
-                'lastname': (75, 330), 
-                'firstname': (75, 360),
-                'dob': (75, 400), 
-                'wt': (75, 430), 
-                'ht': (75, 475),
-                # 'location': (585.36, 347.04), # User has not updated this
-            }
-            # coords_p2 = {'last': (731.52, 86.16)} # Removed
-            coords_p3 = {'wt': (325, 525)}
-
-            if len(pages) > 0: filled_pages.append(fill_page(pages[0], data, coords_p1))
-            if len(pages) > 1: filled_pages.append(pages[1]) # No changes to P2
-            if len(pages) > 2: filled_pages.append(fill_page(pages[2], data, coords_p3))
-            if len(pages) > 3: # Handle extra pages if any
-                 filled_pages.extend(pages[3:])
-
-            merge_pdfs(out_pdf, filled_pages)
-            
-            for p in pages + filled_pages:
-                if os.path.exists(p): os.remove(p)
-            
-            generated_files.append(out_pdf)
-            log_entry = f"SUCCESS: {row_identifier} -> Generated {filename} (template: {template_source})"
-            processing_log.append(log_entry)
+        rows.append((row_identifier, filename, template_source))
+        jobs.append((data, template_key))
 
-        except Exception as e:
-            log_entry = f"ERROR: {row_identifier} - An unexpected error occurred: {e}"
-            app.logger.error(log_entry, exc_info=True)
-            processing_log.append(log_entry)
-            continue
-    
-    processing_log.append("\n---\nReport finished.")
-    report_content = "\n".join(processing_log)
-    report_path = os.path.join(session_completed_folder, "processing_report.txt")
-    with open(report_path, "w") as f:
-        f.write(report_content)
+    templates = {**template_lookup, DEFAULT_TEMPLATE_KEY: default_template}
+    zip_filename = f"CDAI_processed_{run_id}.zip"
 
-    if not generated_files and len(processing_log) <= 4:
-         return "Processing finished, but the data file was empty or no actions were taken.", 400
+    def generate():
+        # Rows are rendered lazily, so each PDF is written and sent as soon as it is ready and only a batch is held in memory
+        buffer = ZipChunkBuffer()
+        # PDFs are already deflated internally, so store them as-is; only the text report is worth compressing
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+            for (row_identifier, filename, template_source), result in zip(rows, render_rows(jobs, templates)):
+                if isinstance(result, Exception):
+                    log_entry = f"ERROR: {row_identifier} - An unexpected error occurred: {result}"
+                    app.logger.error(log_entry, exc_info=result)
+                    processing_log.append(log_entry)
+                    continue
 
-    zip_filename = f"CDAI_processed_{run_id}.zip"
-    zip_path = os.path.join(session_completed_folder, zip_filename)
-    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
-        for f in generated_files:
-            zf.write(f, arcname=os.path.basename(f))
-        zf.write(report_path, arcname="processing_report.txt")
-    
-    @after_this_request
-    def cleanup(response):
-        app.logger.info(f"Cleaning up temporary files for run_id: {run_id}")
-        try:
-            shutil.rmtree(session_upload_folder)
-            shutil.rmtree(session_completed_folder)
-        except Exception as e:
-            app.logger.error(f"Error during cleanup: {e}")
-        return response
+                zf.writestr(filename, result)
+                log_entry = f"SUCCESS: {row_identifier} -> Generated {filename} (template: {template_source})"
+                processing_log.append(log_entry)
+                yield buffer.drain()
+
+            processing_log.append("\n---\nReport finished.")
+            report_content = "\n".join(processing_log)
+            zf.writestr("processing_report.txt", report_content.encode('utf-8'), compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+        yield buffer.drain()
 
-    app.logger.info(f"Sending zip file: {zip_filename} from path {zip_path}")
-    return send_file(zip_path, as_attachment=True)
+    app.logger.info(f"Streaming zip file: {zip_filename}")
+    return Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename={zip_filename}',
+    })
 
 if __name__ == '__main__':
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['COMPLETED_FOLDER'], exist_ok=True)
     app.run(debug=True)